@@ -1,4 +1,8 @@
 import hashlib
+import os
+
+# Подкаталоги кэша, которые уже создали (не дергаем makedirs на каждый запрос)
+_created_dirs: set[str] = set()
 
 
 def cache_key(url: str, quality: str, audio: bool = False) -> str:
@@ -11,7 +15,8 @@ def cache_path(cache_dir: str, key: str, extension: str) -> str:
     """Создает путь к файлу в кэше"""
     # Создаем вложенную структуру для лучшей организации
     subdir = key[:2]
-    import os
     full_dir = os.path.join(cache_dir, subdir)
-    os.makedirs(full_dir, exist_ok=True)
+    if full_dir not in _created_dirs:
+        os.makedirs(full_dir, exist_ok=True)
+        _created_dirs.add(full_dir)
     return os.path.join(full_dir, f"{key}.{extension}")
\ No newline at end of file
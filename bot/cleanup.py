@@ -3,7 +3,12 @@ import time
 
 def cleanup_tmp(path, max_age=3600):
     now = time.time()
-    for f in os.listdir(path):
-        p = os.path.join(path, f)
-        if os.path.isfile(p) and now - os.path.getmtime(p) > max_age:
-            os.remove(p)
+    # scandir отдает тип файла из readdir без лишнего stat
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file() and now - entry.stat().st_mtime > max_age:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                # Файл уже удалил обработчик
+                pass
@@ -15,12 +15,18 @@ TMP_DIR = "/downloads/tmp"
 # yt-dlp
 COOKIES_FILE = os.getenv("COOKIES_FILE")
 
+# FFmpeg
+CPU_COUNT = os.cpu_count() or 4
+# Потоков на один процесс ffmpeg (0 = поделить CPU_COUNT между параллельными задачами)
+FFMPEG_THREADS_PER_JOB = int(os.getenv("BOT_FFMPEG_THREADS_PER_JOB", 0))
+
 # Limits
 MAX_DURATION_SECONDS = int(os.getenv("MAX_DURATION_SECONDS", 1800))
 RATE_LIMIT_SECONDS = int(os.getenv("RATE_LIMIT_SECONDS", 20))
 MAX_FILE_SIZE_MB = 2000
 CACHE_MAX_AGE_DAYS = 7  # Удалять файлы старше 7 дней
 CACHE_MAX_SIZE_MB = 4096  # Максимальный размер кэша 1 ГБ (0 = без ограничения)
+BOT_THREAD_POOL_SIZE = int(os.getenv("BOT_THREAD_POOL_SIZE", 64))  # Потоки для asyncio.to_thread
 # Private mode
 ALLOWED_USERS = set(
     int(uid.strip())
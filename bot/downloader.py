@@ -1,12 +1,14 @@
+import asyncio
 import yt_dlp
 import threading
 import os
 import logging
-import subprocess
 import json
-import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List, Optional
 
+from config import CPU_COUNT, FFMPEG_THREADS_PER_JOB
+
 logger = logging.getLogger(__name__)
 
 
@@ -25,6 +27,15 @@ def _progress_hook(cancel_event, progress_cb):
     return hook
 
 
+def threads_per_job(parallel_jobs: int) -> int:
+    """Потоков ffmpeg на задачу: CPU делится между параллельными задачами, а не занимается каждой целиком"""
+    return FFMPEG_THREADS_PER_JOB or max(1, CPU_COUNT // parallel_jobs)
+
+
+def _ffmpeg_threads_args(threads: Optional[int]) -> list:
+    return ['-threads', str(threads)] if threads else []
+
+
 # ---------------- STANDARD VIDEO ----------------
 
 def download_video(
@@ -34,6 +45,7 @@ def download_video(
     cookies: str | None,
     cancel_event: threading.Event,
     progress_cb,
+    threads: Optional[int] = None,
 ):
     ydl_opts = {
         "format": f"best[height<={quality}]/best",
@@ -50,6 +62,8 @@ def download_video(
         "concurrent_fragment_downloads": 4,
         "http_chunk_size": 10485760,
     }
+    if threads:
+        ydl_opts["postprocessor_args"] = {"ffmpeg": _ffmpeg_threads_args(threads)}
 
     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
         ydl.download([url])
@@ -63,6 +77,7 @@ def download_original_quality(
     cookies: str | None,
     cancel_event: threading.Event,
     progress_cb,
+    threads: Optional[int] = None,
 ):
     """Скачивает видео в оригинальном качестве"""
     ydl_opts = {
@@ -81,6 +96,8 @@ def download_original_quality(
         "concurrent_fragment_downloads": 4,
         "http_chunk_size": 10485760,
     }
+    if threads:
+        ydl_opts["postprocessor_args"] = {"ffmpeg": _ffmpeg_threads_args(threads)}
 
     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
         ydl.download([url])
@@ -94,8 +111,13 @@ def download_tiktok_music(
     cookies: str | None,
     cancel_event: threading.Event,
     progress_cb,
-):
-    """Скачивает только звук из TikTok"""
+    threads: Optional[int] = None,
+    metadata: Optional[dict] = None,
+) -> bool:
+    """
+    Скачивает только звук из TikTok.
+    Возвращает True, если теги metadata записаны при конвертации в mp3.
+    """
     ydl_opts = {
         "format": "bestaudio/best",
         "outtmpl": out_path.replace('.mp3', ''),
@@ -116,39 +138,85 @@ def download_tiktok_music(
         "concurrent_fragment_downloads": 4,
         "http_chunk_size": 10485760,
     }
+    _add_extract_audio_args(ydl_opts, threads, metadata)
 
     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        ydl.download([url])
+        info = ydl.extract_info(url, download=True)
+    return bool(metadata) and _audio_converted(info)
 
 
 # ---------------- ADD METADATA TO AUDIO ----------------
 
-def add_metadata_to_audio(
+# Теги, которые переносим в mp3 (ключ metadata совпадает с тегом ffmpeg)
+_AUDIO_TAGS = ('title', 'artist', 'album')
+
+
+def _audio_metadata_args(metadata: dict) -> list:
+    """Аргументы -metadata для ffmpeg"""
+    metadata_args = []
+    for tag in _AUDIO_TAGS:
+        value = metadata.get(tag)
+        if value:
+            metadata_args.extend(['-metadata', f'{tag}={value[:100]}'])
+    return metadata_args
+
+
+def _add_extract_audio_args(ydl_opts: dict, threads: Optional[int], metadata: Optional[dict]):
+    """Потоки и теги передаем в тот же проход ffmpeg, что конвертирует звук в mp3"""
+    pp_args = _ffmpeg_threads_args(threads)
+    if metadata:
+        pp_args += ['-id3v2_version', '3', *_audio_metadata_args(metadata)]
+    if pp_args:
+        ydl_opts["postprocessor_args"] = {"extractaudio+ffmpeg_o": pp_args}
+
+
+def _audio_converted(info: Optional[dict]) -> bool:
+    """
+    Запускал ли FFmpegExtractAudio ffmpeg. Если исходник уже mp3,
+    yt-dlp пропускает конвертацию — и теги из postprocessor_args не пишутся.
+    Кодек неизвестен — считаем, что не запускал (теги допишет отдельный проход).
+    """
+    acodec = (info or {}).get('acodec')
+    return bool(acodec) and acodec not in ('mp3', 'none')
+
+
+async def run_ffmpeg(cmd: list, timeout: float = 300) -> tuple[int, bytes, bytes]:
+    """Запускает ffmpeg/ffprobe, возвращает (код возврата, stdout, stderr)"""
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+    finally:
+        # Таймаут или отмена — не оставляем процесс работать
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+    return proc.returncode, stdout, stderr
+
+
+async def add_metadata_to_audio(
     input_path: str,
     output_path: str,
     metadata: dict,
-):
-    """Добавляет метаданные к аудио файлу"""
+) -> bool:
+    """
+    Добавляет метаданные к аудио файлу, результат пишет в output_path.
+    ffmpeg запускается как asyncio-подпроцесс и не занимает поток пула.
+    Возвращает False, если метаданные добавить не удалось (исходный файл не тронут).
+    """
     try:
         # Проверяем metadata
         if metadata is None:
             metadata = {}
             
         if not input_path.lower().endswith('.mp3'):
-            shutil.copy2(input_path, output_path)
-            return
-        
-        metadata_args = []
+            return False
         
         # Добавляем метаданные
-        if metadata.get('title'):
-            metadata_args.extend(['-metadata', f'title={metadata["title"][:100]}'])
-        
-        if metadata.get('artist'):
-            metadata_args.extend(['-metadata', f'artist={metadata["artist"][:100]}'])
-        
-        if metadata.get('album'):
-            metadata_args.extend(['-metadata', f'album={metadata["album"][:100]}'])
+        metadata_args = _audio_metadata_args(metadata)
         
         cmd = [
             'ffmpeg',
@@ -161,23 +229,69 @@ def add_metadata_to_audio(
             output_path
         ]
         
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=30
-        )
-        
-        if result.returncode != 0:
-            shutil.copy2(input_path, output_path)
+        rc, _, stderr = await run_ffmpeg(cmd, timeout=30)
+        if rc != 0:
+            logger.error(f"Metadata error: {stderr[-4096:].decode('utf-8', 'replace')}")
+            return False
+        return True
             
     except Exception as e:
         logger.error(f"Metadata error: {e}")
-        shutil.copy2(input_path, output_path)
+        return False
 
 
 # ---------------- PLAYLIST DOWNLOAD ----------------
 
+def _download_playlist_entry(
+    ydl_opts: dict,
+    threads: int,
+    i: int,
+    total_videos: int,
+    entry: dict,
+) -> Optional[str]:
+    """Скачивает одно видео плейлиста, возвращает путь к файлу или None"""
+    # YoutubeDL правит переданный словарь как self.params — каждому потоку своя копия
+    ydl_opts = {**ydl_opts, "postprocessor_args": {"ffmpeg": _ffmpeg_threads_args(threads)}}
+    video_url = entry['url']
+    video_title = entry.get('title', f'Video {i}')
+    
+    logger.info(f"Downloading video {i}/{total_videos}: {video_title}")
+    
+    try:
+        # Свой YoutubeDL (и свои опции) на каждое видео — экземпляр не потокобезопасен
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(video_url, download=True)
+            
+            if not info:
+                logger.error(f"Failed to extract info for video {i}")
+                return None
+            
+            # Получаем имя фактически созданного файла
+            filename = ydl.prepare_filename(info)
+        
+        # Проверяем существование файла
+        if os.path.exists(filename):
+            logger.info(f"Successfully downloaded: {os.path.basename(filename)}")
+            return filename
+        
+        # Ищем файл с другим расширением
+        base_name = filename.rsplit('.', 1)[0]
+        for ext in ['.mp4', '.mkv', '.webm', '.flv']:
+            alt_path = base_name + ext
+            if os.path.exists(alt_path):
+                logger.info(f"Found file with extension {ext}: {os.path.basename(alt_path)}")
+                return alt_path
+        
+        logger.error(f"File not found for video {i}")
+        
+    except DownloadCancelled:
+        raise
+    except Exception as e:
+        logger.error(f"Error downloading video {i} ({video_title}): {e}")
+    
+    return None
+
+
 def download_playlist_videos(
     playlist_info: dict,
     output_dir: str,
@@ -185,15 +299,14 @@ def download_playlist_videos(
     cancel_event: threading.Event,
     progress_cb,
 ) -> List[str]:
-    """Скачивает все видео из плейлиста"""
-    downloaded_files = []
-    
+    """Скачивает все видео из плейлиста (несколько параллельно)"""
     ydl_opts = {
         "format": "best[height<=1080]/best",
         "outtmpl": os.path.join(output_dir, "%(title)s [%(id)s].%(ext)s"),
         "merge_output_format": "mp4",
         "cookiefile": cookies,
-        "progress_hooks": [_progress_hook(cancel_event, progress_cb)],
+        # Хук только для отмены: прогресс считаем по готовым видео
+        "progress_hooks": [_progress_hook(cancel_event, None)],
         "quiet": True,
         "no_warnings": True,
         "ignoreerrors": True,
@@ -204,55 +317,47 @@ def download_playlist_videos(
     }
 
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            entries = playlist_info.get('entries', [])
-            total_videos = len(entries)
-            
-            logger.info(f"Starting playlist download with {total_videos} videos")
-            
-            for i, entry in enumerate(entries, 1):
-                if cancel_event.is_set():
-                    raise DownloadCancelled("Cancelled by user")
-                
-                if not entry.get('url'):
-                    logger.warning(f"Entry {i} has no URL, skipping")
-                    continue
-                
-                video_url = entry['url']
-                video_title = entry.get('title', f'Video {i}')
-                
-                logger.info(f"Downloading video {i}/{total_videos}: {video_title}")
-                
-                try:
-                    # Загружаем видео
-                    info = ydl.extract_info(video_url, download=True)
-                    
-                    if not info:
-                        logger.error(f"Failed to extract info for video {i}")
-                        continue
-                    
-                    # Получаем имя фактически созданного файла
-                    filename = ydl.prepare_filename(info)
+        entries = playlist_info.get('entries', [])
+        total_videos = len(entries)
+        
+        logger.info(f"Starting playlist download with {total_videos} videos")
+        
+        jobs = []
+        for i, entry in enumerate(entries, 1):
+            if not entry.get('url'):
+                logger.warning(f"Entry {i} has no URL, skipping")
+                continue
+            jobs.append((i, entry))
+        
+        if not jobs:
+            return []
+        
+        results = {}
+        # Больше 8 потоков упирается в ограничения CDN
+        workers = min(8, len(jobs))
+        threads = threads_per_job(workers)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='playlist') as pool:
+            futures = {
+                pool.submit(_download_playlist_entry, ydl_opts, threads, i, total_videos, entry): i
+                for i, entry in jobs
+            }
+            try:
+                for future in as_completed(futures):
+                    if cancel_event.is_set():
+                        raise DownloadCancelled("Cancelled by user")
                     
-                    # Проверяем существование файла
-                    if os.path.exists(filename):
-                        downloaded_files.append(filename)
-                        logger.info(f"Successfully downloaded: {os.path.basename(filename)}")
-                    else:
-                        # Ищем файл с другим расширением
-                        base_name = filename.rsplit('.', 1)[0]
-                        for ext in ['.mp4', '.mkv', '.webm', '.flv']:
-                            alt_path = base_name + ext
-                            if os.path.exists(alt_path):
-                                downloaded_files.append(alt_path)
-                                logger.info(f"Found file with extension {ext}: {os.path.basename(alt_path)}")
-                                break
-                        else:
-                            logger.error(f"File not found for video {i}")
-                            
-                except Exception as e:
-                    logger.error(f"Error downloading video {i} ({video_title}): {e}")
-                    continue
+                    path = future.result()
+                    if path:
+                        results[futures[future]] = path
+                    if progress_cb:
+                        progress_cb({"status": "finished"})
+            except BaseException:
+                # Не запускаем оставшиеся видео, запущенные остановит хук отмены
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+        
+        # Возвращаем в порядке плейлиста
+        downloaded_files = [results[i] for i in sorted(results)]
         
         logger.info(f"Playlist download complete. Downloaded {len(downloaded_files)} files")
         return downloaded_files
@@ -270,7 +375,14 @@ def download_audio(
     cookies: str | None,
     cancel_event: threading.Event,
     progress_cb,
-):
+    metadata: Optional[dict] = None,
+    threads: Optional[int] = None,
+    info: Optional[dict] = None,
+) -> bool:
+    """
+    Скачивает звук и конвертирует в mp3.
+    Возвращает True, если теги metadata записаны при конвертации.
+    """
     ydl_opts = {
         "format": "bestaudio/best",
         "outtmpl": out_path.replace('.mp3', ''),
@@ -292,6 +404,17 @@ def download_audio(
         "concurrent_fragment_downloads": 4,
         "http_chunk_size": 10485760,
     }
+    
+    _add_extract_audio_args(ydl_opts, threads, metadata)
 
     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        ydl.download([url])
\ No newline at end of file
+        if info is not None:
+            # Информация уже извлечена обработчиком — не запрашиваем страницу второй раз.
+            # Работаем с копией: словарь общий с INFO_CACHE, а yt-dlp дописывает в него поля
+            info = ydl.process_ie_result(
+                ydl.sanitize_info(dict(info), remove_private_keys=True),
+                download=True,
+            )
+        else:
+            info = ydl.extract_info(url, download=True)
+    return bool(metadata) and _audio_converted(info)
\ No newline at end of file
@@ -1,26 +1,38 @@
 import os
+import json
 import asyncio
+import heapq
 import threading
 import logging
-import subprocess
+import shutil
 import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional
+from typing import Literal, Optional
 
+import aiofiles.os as aos
+from cachetools import LRUCache, TTLCache
 from aiogram import Bot, Dispatcher, F
 from aiogram.types import Message, CallbackQuery, FSInputFile, InputMediaDocument
 from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 
 from config import (
     BOT_TOKEN,
     LOCAL_API_URL,
+    DOWNLOAD_DIR,
     CACHE_DIR,
     TMP_DIR,
     COOKIES_FILE,
     RATE_LIMIT_SECONDS,
     CACHE_MAX_AGE_DAYS,
     CACHE_MAX_SIZE_MB,
+    BOT_THREAD_POOL_SIZE,
+    CPU_COUNT,
 )
 from keyboards import (
     quality_keyboard, 
@@ -36,6 +48,8 @@ from downloader import (
     download_playlist_videos,
     download_tiktok_music,
     add_metadata_to_audio,  # Только для аудио
+    run_ffmpeg,
+    threads_per_job,
     DownloadCancelled,
 )
 from middleware import PrivateMiddleware
@@ -54,88 +68,237 @@ logger = logging.getLogger(__name__)
 os.makedirs(CACHE_DIR, exist_ok=True)
 os.makedirs(TMP_DIR, exist_ok=True)
 
+# os.replace между разными ФС (например, разные volume в Docker) не работает,
+# поэтому в таком случае временные файлы пишем в служебный каталог внутри кэша
+_CACHE_TMP_SAME_FS = os.stat(TMP_DIR).st_dev == os.stat(CACHE_DIR).st_dev
+WORK_DIR = TMP_DIR if _CACHE_TMP_SAME_FS else os.path.join(CACHE_DIR, ".work")
+os.makedirs(WORK_DIR, exist_ok=True)
+
+class KeepAliveSession(AiohttpSession):
+    """
+    AiohttpSession, который дольше держит соединения с Bot API открытыми,
+    чтобы частые edit_text/answer не открывали новое TCP/TLS-соединение.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(limit=64, **kwargs)
+        # AiohttpSession сам создает TCPConnector из этих параметров
+        self._connector_init.update(limit_per_host=32, keepalive_timeout=75)
+
+
 # Инициализация бота с локальным API (если используется)
 if LOCAL_API_URL:
     api_server = TelegramAPIServer.from_base(LOCAL_API_URL)
-    session = AiohttpSession(api=api_server)
-    bot = Bot(token=BOT_TOKEN, session=session)
+    session = KeepAliveSession(api=api_server)
 else:
-    bot = Bot(token=BOT_TOKEN)
+    session = KeepAliveSession()
+bot = Bot(token=BOT_TOKEN, session=session)
 
 dp = Dispatcher()
 
+# Ограничение на одновременные перекодирования, чтобы не душить CPU
+FFMPEG_JOBS = max(1, CPU_COUNT // 2)
+FFMPEG_SEM = asyncio.Semaphore(FFMPEG_JOBS)
+# Потоков на перекодирование: при FFMPEG_JOBS параллельных задачах суммарно не больше vCPU
+FFMPEG_THREADS = threads_per_job(FFMPEG_JOBS)
+
+# Отдельные пулы: лёгкие запросы метаданных не ждут за тяжёлыми загрузками
+META_POOL = ThreadPoolExecutor(max_workers=BOT_THREAD_POOL_SIZE, thread_name_prefix='bot-io')
+DL_WORKERS = 4
+DL_POOL = ThreadPoolExecutor(max_workers=DL_WORKERS, thread_name_prefix='dl')
+# Потоков ffmpeg внутри yt-dlp на одну загрузку
+DL_FFMPEG_THREADS = threads_per_job(DL_WORKERS)
+
 # Регистрация middleware
 private_middleware = PrivateMiddleware()
 dp.message.middleware(private_middleware)
 dp.callback_query.middleware(private_middleware)
 
-USER_URLS: dict[int, str] = {}
-USER_DATA: dict[int, dict] = {}
-ACTIVE_DOWNLOADS: dict[int, dict] = {}
+# Ограничены по размеру и времени жизни, чтобы не расти бесконечно
+# Ссылку держим сутки: кнопку качества могут нажать и через несколько часов
+USER_URLS: TTLCache = TTLCache(maxsize=10_000, ttl=24 * 3600)
+# Состояние выбора (в т.ч. информация о плейлисте) дольше часа не нужно
+USER_DATA: TTLCache = TTLCache(maxsize=10_000, ttl=3600)
+# TTL — страховка на случай, если запись не удалилась в finally
+ACTIVE_DOWNLOADS: TTLCache = TTLCache(maxsize=1000, ttl=2 * 3600)
+# Загрузки, которые идут прямо сейчас: ключ кэша -> future с результатом
+INFLIGHT: dict[str, asyncio.Future] = {}
 
 # -------------------- cache cleaning --------------------
 
+# Индекс кэша: путь -> (mtime, размер).
+# Строится один раз при старте, дальше обновляется при записи и удалении файлов.
+CACHE_INDEX: dict[str, tuple[float, int]] = {}
+# Очистка работает в отдельном потоке, поэтому изменения индекса — под локом
+_cache_index_lock = threading.Lock()
+
+
+def _register_cache_file(path: str) -> Optional[int]:
+    """Добавляет файл в индекс кэша (один stat), возвращает его размер"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    with _cache_index_lock:
+        CACHE_INDEX[path] = (st.st_mtime, st.st_size)
+    return st.st_size
+
+
+def _touch_cache_file(path: str, size: int):
+    """Отмечает обращение к файлу кэша: mtime служит временем последнего доступа"""
+    now = time.time()
+    try:
+        os.utime(path, (now, now))
+    except OSError:
+        return
+    with _cache_index_lock:
+        CACHE_INDEX[path] = (now, size)
+
+
+def _stat_or_none(path: str) -> Optional[os.stat_result]:
+    """Один stat вместо пары exists + getsize"""
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
+
+def _remove_quiet(path: str):
+    """Удаляет файл одним unlink, без проверки exists заранее"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _forget_cache_file(path: str):
+    """Убирает файл из индекса кэша"""
+    with _cache_index_lock:
+        CACHE_INDEX.pop(path, None)
+
+
+def _cache_index_snapshot() -> list[tuple[str, float, int]]:
+    """Копия индекса в виде (путь, mtime, размер)"""
+    with _cache_index_lock:
+        return [(path, mtime, size) for path, (mtime, size) in CACHE_INDEX.items()]
+
+
+def _iter_cache_entries(root: str):
+    """
+    Обходит кэш одним проходом os.scandir.
+    Возвращает кортежи (путь, mtime, размер) — по одному stat на файл.
+    """
+    stack = [root]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    try:
+                        if entry.path == WORK_DIR:
+                            # Недокачанные файлы — не кэш, их чистит cleanup_tmp
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            st = entry.stat(follow_symlinks=False)
+                            yield entry.path, st.st_mtime, st.st_size
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+
+
+def _remove_cache_file(path: str):
+    """Удаляет файл из кэша и из индекса"""
+    _remove_quiet(path)
+    _forget_cache_file(path)
+
+
+# Те же операции для обработчиков: syscall уходит в пул потоков, а не блокирует event loop
+_astat_or_none = aos.wrap(_stat_or_none)
+_aremove_quiet = aos.wrap(_remove_quiet)
+_aregister_cache_file = aos.wrap(_register_cache_file)
+_atouch_cache_file = aos.wrap(_touch_cache_file)
+_aremove_cache_file = aos.wrap(_remove_cache_file)
+
+
+def rebuild_cache_index():
+    """Заполняет индекс кэша одним обходом диска"""
+    entries = {path: (mtime, size) for path, mtime, size in _iter_cache_entries(CACHE_DIR)}
+    with _cache_index_lock:
+        CACHE_INDEX.clear()
+        CACHE_INDEX.update(entries)
+    logger.info(f"Cache index built: {len(entries)} files")
+
+
 def cleanup_old_cache():
     """
-    Очищает старые файлы из кэша
+    Очищает старые файлы из кэша.
+
+    Сначала удаляются файлы, к которым не обращались дольше CACHE_MAX_AGE_DAYS.
+    Если кэш все еще больше лимита, вытесняются файлы с наибольшим
+    приоритетом размер × возраст (упрощенная LRBU-политика): один большой
+    давно не нужный файл освобождает больше места, чем много мелких свежих.
     """
     try:
         current_time = time.time()
         deleted_count = 0
         deleted_size = 0
         
+        # Работаем по индексу, без обхода диска
+        files = _cache_index_snapshot()
+        remaining = []
+        
         # Удаляем файлы старше CACHE_MAX_AGE_DAYS дней
-        if CACHE_MAX_AGE_DAYS > 0:
-            cutoff_time = current_time - (CACHE_MAX_AGE_DAYS * 24 * 3600)
-            
-            for root, dirs, files in os.walk(CACHE_DIR):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    try:
-                        file_mtime = os.path.getmtime(file_path)
-                        if file_mtime < cutoff_time:
-                            file_size = os.path.getsize(file_path)
-                            os.remove(file_path)
-                            deleted_count += 1
-                            deleted_size += file_size
-                            logger.info(f"Deleted old cache file: {file}")
-                    except Exception as e:
-                        logger.error(f"Error deleting file {file}: {e}")
+        cutoff_time = current_time - (CACHE_MAX_AGE_DAYS * 24 * 3600)
+        for file_path, mtime, size in files:
+            if CACHE_MAX_AGE_DAYS > 0 and mtime < cutoff_time:
+                try:
+                    _remove_cache_file(file_path)
+                    deleted_count += 1
+                    deleted_size += size
+                    logger.info(f"Deleted old cache file: {os.path.basename(file_path)}")
+                    continue
+                except Exception as e:
+                    logger.error(f"Error deleting file {file_path}: {e}")
+            remaining.append((file_path, mtime, size))
         
         # Если указан максимальный размер кэша, проверяем его
         if CACHE_MAX_SIZE_MB > 0:
-            total_size_mb = get_cache_size_mb()
+            total_size_mb = sum(size for _, _, size in remaining) / (1024 * 1024)
             if total_size_mb > CACHE_MAX_SIZE_MB:
-                # Сортируем файлы по времени изменения (старые первыми)
-                files_with_mtime = []
-                for root, dirs, files in os.walk(CACHE_DIR):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        try:
-                            mtime = os.path.getmtime(file_path)
-                            size = os.path.getsize(file_path)
-                            files_with_mtime.append((file_path, mtime, size))
-                        except:
-                            pass
-                
-                # Сортируем по времени (старые первыми)
-                files_with_mtime.sort(key=lambda x: x[1])
-                
-                # Удаляем старые файлы пока не достигнем лимита
+                # Удаляем файлы пока не достигнем лимита
                 target_size_mb = CACHE_MAX_SIZE_MB * 0.8
+                excess_bytes = int((total_size_mb - target_size_mb) * 1024 * 1024)
                 
-                for file_path, mtime, size in files_with_mtime:
-                    if total_size_mb <= target_size_mb:
-                        break
+                def priority(entry):
+                    # Сначала самые большие и давно не использованные
+                    return entry[2] * (current_time - entry[1])
+                
+                # Обычно хватает нескольких файлов, поэтому не сортируем весь кэш,
+                # а берем k лучших кандидатов и увеличиваем k, если не хватило
+                k = 64
+                while excess_bytes > 0 and remaining:
+                    candidates = heapq.nlargest(k, remaining, key=priority)
+                    for file_path, mtime, size in candidates:
+                        if excess_bytes <= 0:
+                            break
+                        
+                        try:
+                            _remove_cache_file(file_path)
+                            deleted_count += 1
+                            deleted_size += size
+                            excess_bytes -= size
+                            logger.info(f"Deleted cache file to free space: {os.path.basename(file_path)}")
+                        except Exception as e:
+                            logger.error(f"Error deleting file {file_path}: {e}")
                     
-                    try:
-                        os.remove(file_path)
-                        deleted_count += 1
-                        deleted_size += size
-                        total_size_mb -= size / (1024 * 1024)
-                        logger.info(f"Deleted cache file to free space: {os.path.basename(file_path)}")
-                    except Exception as e:
-                        logger.error(f"Error deleting file {file_path}: {e}")
+                    if len(candidates) == len(remaining):
+                        break
+                    processed = {path for path, _, _ in candidates}
+                    remaining = [entry for entry in remaining if entry[0] not in processed]
+                    k *= 4
         
         if deleted_count > 0:
             logger.info(f"Cache cleanup: deleted {deleted_count} files, freed {deleted_size / (1024*1024):.2f} MB")
@@ -146,23 +309,11 @@ def cleanup_old_cache():
         logger.error(f"Error in cache cleanup: {e}")
 
 
-def get_cache_size_mb():
-    """Возвращает размер кэша в МБ"""
-    total_size = 0
-    for root, dirs, files in os.walk(CACHE_DIR):
-        for file in files:
-            file_path = os.path.join(root, file)
-            try:
-                total_size += os.path.getsize(file_path)
-            except:
-                pass
-    return total_size / (1024 * 1024)
-
-
 async def scheduled_cache_cleanup():
     """Периодическая очистка кэша"""
-    # Запускаем очистку сразу при старте
+    # Строим индекс и запускаем очистку сразу при старте
     logger.info("Running initial cache cleanup...")
+    await asyncio.to_thread(rebuild_cache_index)
     await asyncio.to_thread(cleanup_old_cache)
     
     last_cleanup_day = datetime.now().day
@@ -177,6 +328,11 @@ async def scheduled_cache_cleanup():
                 logger.info("Starting scheduled cache cleanup...")
                 await asyncio.to_thread(cleanup_old_cache)
                 last_cleanup_day = current_day
+            
+            # Убираем просроченные записи пользователей
+            USER_URLS.expire()
+            USER_DATA.expire()
+            ACTIVE_DOWNLOADS.expire()
                 
             # Ждем 5 минут перед следующей проверкой
             await asyncio.sleep(300)
@@ -188,88 +344,339 @@ async def scheduled_cache_cleanup():
 
 # -------------------- helpers --------------------
 
-def render_bar(percent: float, size: int = 10) -> str:
-    filled = int(size * percent / 100)
-    return "█" * filled + "░" * (size - filled)
+# Кэш метаданных yt-dlp: url -> (время получения, info)
+INFO_CACHE: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+INFO_CACHE_TTL = 60
+INFO_CACHE_SIZE = 256
 
 
-def make_progress_cb(loop, message):
-    last_percent = {"value": 0}
-    last_update = {"time": 0}
+# Запросы метаданных, которые выполняются прямо сейчас
+_INFO_PENDING: dict[str, asyncio.Task] = {}
 
-    async def update(d):
-        try:
-            downloaded = d.get("downloaded_bytes", 0)
-            total = d.get("total_bytes") or d.get("total_bytes_estimate") or 1
-            
-            if total <= 0:
+
+def _cached_info(url: str) -> Optional[dict]:
+    """Возвращает свежие метаданные из INFO_CACHE или None"""
+    cached = INFO_CACHE.get(url)
+    if cached is None or time.time() - cached[0] >= INFO_CACHE_TTL:
+        return None
+    INFO_CACHE.move_to_end(url)
+    return cached[1]
+
+
+async def _fetch_info(url: str) -> Optional[dict]:
+    try:
+        info = await asyncio.to_thread(extract_info, url, COOKIES_FILE)
+        if info:
+            INFO_CACHE[url] = (time.time(), info)
+            INFO_CACHE.move_to_end(url)
+            while len(INFO_CACHE) > INFO_CACHE_SIZE:
+                INFO_CACHE.popitem(last=False)
+        return info
+    finally:
+        _INFO_PENDING.pop(url, None)
+
+
+def _start_info_fetch(url: str) -> asyncio.Task:
+    """Запускает запрос метаданных, если он еще не идет"""
+    task = _INFO_PENDING.get(url)
+    if task is None:
+        task = asyncio.create_task(_fetch_info(url))
+        _INFO_PENDING[url] = task
+    return task
+
+
+async def get_info_cached(url: str) -> Optional[dict]:
+    """
+    extract_info с кэшем на INFO_CACHE_TTL секунд.
+    Повторные запросы одной ссылки не ходят в сеть заново,
+    а одновременные — ждут один и тот же запрос.
+    """
+    info = _cached_info(url)
+    if info is not None:
+        return info
+    return await asyncio.shield(_start_info_fetch(url))
+
+
+def prewarm_info(url: str):
+    """Заранее запрашивает метаданные в фоне, чтобы обработчик взял их из кэша"""
+    if _cached_info(url) is None:
+        _start_info_fetch(url)
+
+
+def work_path(key: str, suffix: str) -> str:
+    """
+    Путь для временного файла загрузки.
+    WORK_DIR всегда на той же ФС, что и final_path, поэтому os.replace в кэш —
+    это переименование, а не копирование.
+    """
+    return os.path.join(WORK_DIR, f"{key}{suffix}")
+
+
+# Ссылки на фоновые задачи, чтобы их не собрал GC до завершения
+_BACKGROUND_TASKS: set[asyncio.Task] = set()
+
+
+def run_in_background(func, *args) -> asyncio.Task:
+    """Запускает блокирующую функцию в потоке, не дожидаясь результата"""
+    task = asyncio.create_task(asyncio.to_thread(func, *args))
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+    return task
+
+
+_tmp_cleanup_task: Optional[asyncio.Task] = None
+
+
+def cleanup_work_dirs():
+    """Удаляет забытые временные файлы из TMP_DIR и WORK_DIR"""
+    cleanup_tmp(TMP_DIR)
+    if WORK_DIR != TMP_DIR:
+        cleanup_tmp(WORK_DIR)
+
+
+def schedule_tmp_cleanup():
+    """
+    Запускает очистку временных каталогов в фоне, не задерживая ответ пользователю.
+    Если очистка уже идет — новую не запускаем.
+    """
+    global _tmp_cleanup_task
+    if _tmp_cleanup_task is not None and not _tmp_cleanup_task.done():
+        return
+    _tmp_cleanup_task = run_in_background(cleanup_work_dirs)
+
+
+class CancelEvent(asyncio.Event):
+    """
+    Событие отмены на стороне event loop.
+    При set() взводит threading.Event, который проверяет поток загрузки.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.thread_event = threading.Event()
+        # Поток загрузки, брошенный после отмены и еще не завершившийся
+        self.worker: Optional[Future] = None
+
+    def set(self):
+        super().set()
+        self.thread_event.set()
+
+
+def _consume_result(future: asyncio.Future):
+    """Забирает исключение брошенной загрузки, чтобы asyncio не ругался в лог"""
+    if not future.cancelled():
+        future.exception()
+
+
+async def run_download(cancel_event: CancelEvent, func, *args, **kwargs):
+    """
+    Запускает блокирующую загрузку yt-dlp в пуле DL_POOL.
+    При отмене сразу бросает DownloadCancelled, не дожидаясь,
+    пока поток заметит thread_event в хуке прогресса.
+    Если поток еще работает, он остается в cancel_event.worker (см. after_worker).
+    """
+    worker = DL_POOL.submit(func, *args, **kwargs)
+    dl_future = asyncio.wrap_future(worker)
+    cancel_task = asyncio.create_task(cancel_event.wait())
+    try:
+        await asyncio.wait({dl_future, cancel_task}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        cancel_task.cancel()
+        if not dl_future.done():
+            # Еще в очереди пула — просто не запускаем; уже идет — остановится на хуке прогресса
+            worker.cancel()
+            cancel_event.worker = worker
+            dl_future.add_done_callback(_consume_result)
+
+    if dl_future.done() and not dl_future.cancelled():
+        return dl_future.result()
+    raise DownloadCancelled("Cancelled by user")
+
+
+def after_worker(cancel_event: CancelEvent, func, *args):
+    """
+    Вызывает func, когда поток загрузки действительно закончил работу.
+    После отмены он может еще писать во временный файл (например, в ffmpeg
+    после загрузки хук прогресса не вызывается) — тогда ждем его.
+    Колбэки выполняются по порядку регистрации: удаление файлов раньше освобождения ключа.
+    """
+    worker = cancel_event.worker
+    if worker is None or worker.done():
+        func(*args)
+        return
+    loop = asyncio.get_running_loop()
+    # Колбэк concurrent future вызывается в потоке пула — возвращаемся в event loop
+    worker.add_done_callback(lambda _: loop.call_soon_threadsafe(func, *args))
+
+
+class EditThrottler:
+    """
+    Обертка над статусным сообщением: не чаще одного edit_text за min_interval.
+    Первая правка уходит сразу, частые правки схлопываются —
+    через паузу отправляется только последний текст.
+    """
+
+    def __init__(self, message: Message, min_interval: float = 0.5):
+        self.message = message
+        self.min_interval = min_interval
+        self._last_time = 0.0
+        self._last: Optional[tuple[str, dict]] = None
+        self._pending: Optional[tuple[str, dict]] = None
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    def _delay(self) -> float:
+        return self._last_time + self.min_interval - time.monotonic()
+
+    def submit(self, text: str, **kwargs):
+        """Ставит текст на отправку, не дожидаясь запроса (для колбэков event loop)"""
+        self._pending = (text, kwargs)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._trailing(max(0.0, self._delay())))
+            _BACKGROUND_TASKS.add(self._task)
+            self._task.add_done_callback(_BACKGROUND_TASKS.discard)
+
+    async def edit_text(self, text: str, **kwargs):
+        if (self._task is None or self._task.done()) and self._delay() <= 0:
+            self._pending = (text, kwargs)
+            await self._apply()
+        else:
+            self.submit(text, **kwargs)
+
+    async def flush(self):
+        """Сразу отправляет отложенный текст, если он есть"""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        await self._apply()
+
+    async def _trailing(self, delay: float):
+        while True:
+            await asyncio.sleep(delay)
+            # shield: flush() отменяет только ожидание, а не запрос в полете
+            await asyncio.shield(self._apply())
+            # Пока шел запрос, могли прислать новый текст — submit видел живую задачу
+            if self._pending is None:
                 return
-                
-            percent = min(100, downloaded * 100 / total)
+            delay = max(0.0, self._delay())
 
-            current_time = time.time()
-            if percent - last_percent["value"] < 2 and current_time - last_update["time"] < 2:
+    async def _apply(self):
+        async with self._lock:
+            pending, self._pending = self._pending, None
+            # Телеграм отвечает ошибкой на правку без изменений
+            if pending is None or pending == self._last:
                 return
-                
-            last_percent["value"] = percent
-            last_update["time"] = current_time
+            self._last = pending
+            self._last_time = time.monotonic()
+            text, kwargs = pending
+            try:
+                await self.message.edit_text(text, **kwargs)
+            except Exception as e:
+                logger.error(f"Error editing status: {e}")
+
+
+BAR_SIZE = 10
+# Все состояния полосы прогресса, посчитанные один раз
+BAR_CACHE = tuple("█" * i + "░" * (BAR_SIZE - i) for i in range(BAR_SIZE + 1))
+
+
+def render_bar(percent: float) -> str:
+    return BAR_CACHE[int(BAR_SIZE * percent / 100)]
 
-            bar = render_bar(percent)
-            eta = d.get("eta")
+
+@dataclass(slots=True)
+class _ProgState:
+    """Изменяемое состояние колбэка прогресса"""
+    percent: float = 0.0
+    time: float = 0.0
+    shown: int = -1
+    count: int = 0
+
+
+def make_progress_cb(loop, status: EditThrottler):
+    state = _ProgState()
+
+    def render(d) -> Optional[str]:
+        """Считает текст прогресса в потоке загрузки; None — обновлять не нужно"""
+        downloaded = d.get("downloaded_bytes", 0)
+        total = d.get("total_bytes") or d.get("total_bytes_estimate") or 1
+        
+        if total <= 0:
+            return None
+            
+        percent = min(100, downloaded * 100 / total)
+
+        current_time = time.time()
+        if percent - state.percent < 2 and current_time - state.time < 2:
+            return None
             
-            if eta is None or eta == "?":
+        state.percent = percent
+        state.time = current_time
+
+        # Процент на экране не изменится — не тратим запрос к Telegram
+        shown_percent = round(percent)
+        if shown_percent == state.shown:
+            return None
+        state.shown = shown_percent
+
+        bar = render_bar(percent)
+        eta = d.get("eta")
+        
+        if eta is None or eta == "?":
+            eta_str = "?"
+        else:
+            try:
+                eta_str = str(int(float(eta)))
+            except (ValueError, TypeError):
                 eta_str = "?"
-            else:
-                try:
-                    eta_str = str(int(float(eta)))
-                except (ValueError, TypeError):
-                    eta_str = "?"
 
-            text = (
-                "⏬ <b>Загрузка</b>\n"
-                f"<code>{bar}</code> {percent:.0f}%\n"
-                f"⏱ Осталось: {eta_str} сек"
-            )
+        return (
+            "⏬ <b>Загрузка</b>\n"
+            f"<code>{bar}</code> {percent:.0f}%\n"
+            f"⏱ Осталось: {eta_str} сек"
+        )
 
-            await message.edit_text(
-                text,
-                reply_markup=cancel_keyboard(),
-                parse_mode="HTML"
-            )
-        except Exception as e:
-            logger.error(f"Error updating progress: {e}")
+    def schedule(text: str):
+        # Выполняется в event loop; частые обновления схлопывает EditThrottler
+        status.submit(text, reply_markup=cancel_keyboard(), parse_mode="HTML")
 
     def cb(d):
-        asyncio.run_coroutine_threadsafe(update(d), loop)
+        try:
+            text = render(d)
+        except Exception as e:
+            logger.error(f"Error updating progress: {e}")
+            return
+        if text is not None:
+            loop.call_soon_threadsafe(schedule, text)
 
     return cb
 
 
 def make_playlist_progress_cb(loop, message, total_videos: int):
-    current_video = {"value": 0}
-    last_update = {"time": 0}
+    state = _ProgState()
 
     async def update(d):
         try:
+            if d.get("status") != "finished":
+                return
+            # Считаем каждое готовое видео, даже если сообщение не обновляем
+            state.count += 1
+            
             current_time = time.time()
-            if current_time - last_update["time"] < 3:
+            if current_time - state.time < 3 and state.count < total_videos:
                 return
                 
-            last_update["time"] = current_time
+            state.time = current_time
 
-            if d.get("status") == "finished":
-                current_video["value"] += 1
-                
-                text = (
-                    f"📁 <b>Загрузка плейлиста</b>\n"
-                    f"📹 Видео: {current_video['value']}/{total_videos}\n"
-                    f"⏳ Продолжаем загрузку..."
-                )
-
-                await message.edit_text(
-                    text,
-                    parse_mode="HTML"
-                )
+            text = (
+                f"📁 <b>Загрузка плейлиста</b>\n"
+                f"📹 Видео: {state.count}/{total_videos}\n"
+                f"⏳ Продолжаем загрузку..."
+            )
+
+            await message.edit_text(
+                text,
+                parse_mode="HTML"
+            )
         except Exception as e:
             logger.error(f"Error updating playlist progress: {e}")
 
@@ -279,27 +686,108 @@ def make_playlist_progress_cb(loop, message, total_videos: int):
     return cb
 
 
-def optimize_for_telegram(input_path: str, output_path: str) -> bool:
+def _link_or_copy(src: str, dst: str):
+    """
+    Делает dst копией src: жесткой ссылкой, если это одна ФС (без копирования данных),
+    иначе обычным копированием.
+    """
+    # ffmpeg мог оставить недописанный файл
+    _remove_quiet(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+_alink_or_copy = aos.wrap(_link_or_copy)
+
+
+async def is_telegram_ready(input_path: str) -> bool:
+    """
+    Проверяет через ffprobe, можно ли отдать файл без перекодирования:
+    h264 + aac (или без звука), чётные размеры
+    """
+    try:
+        rc, out, _ = await run_ffmpeg([
+            'ffprobe',
+            '-v', 'error',
+            '-show_entries', 'stream=codec_type,codec_name,width,height',
+            '-of', 'json',
+            input_path
+        ], timeout=30)
+        if rc != 0:
+            return False
+        streams = json.loads(out).get('streams', [])
+    except Exception as e:
+        logger.warning(f"ffprobe failed: {e}")
+        return False
+
+    video = [s for s in streams if s.get('codec_type') == 'video']
+    audio = [s for s in streams if s.get('codec_type') == 'audio']
+    if len(video) != 1 or video[0].get('codec_name') != 'h264':
+        return False
+    if any(s.get('codec_name') != 'aac' for s in audio):
+        return False
+    width, height = video[0].get('width') or 1, video[0].get('height') or 1
+    return width % 2 == 0 and height % 2 == 0
+
+
+@asynccontextmanager
+async def ffmpeg_slot():
+    """
+    Занимает место в FFMPEG_SEM и отдает число потоков для этого перекодирования.
+    Число фиксированное: если бы задача брала потоки по числу уже идущих,
+    то при появлении новых она бы не уменьшала свою долю и CPU был бы перегружен.
+    """
+    async with FFMPEG_SEM:
+        yield FFMPEG_THREADS
+
+
+async def optimize_for_telegram(input_path: str, output_path: str, threads: int = 1) -> bool:
     """
     Оптимизирует видео для телеграма (без метаданных)
     """
     try:
-        import shutil
-        
         # Проверяем размер файла
-        file_size_mb = os.path.getsize(input_path) / (1024 * 1024)
+        file_size_mb = (await aos.stat(input_path)).st_size / (1024 * 1024)
+        
+        # Файл уже подходит — только переносим moov в начало, без перекодирования
+        if file_size_mb <= 50 and await is_telegram_ready(input_path):
+            rc, _, stderr = await run_ffmpeg([
+                'ffmpeg',
+                '-loglevel', 'error',
+                '-nostats',
+                '-i', input_path,
+                '-map', '0',
+                '-c', 'copy',
+                '-movflags', '+faststart',
+                '-y',
+                output_path
+            ])
+            if rc == 0:
+                return True
+            logger.warning(f"Remux failed, re-encoding: {stderr[-4096:].decode('utf-8', 'replace')}")
         
         # Если файл больше 50 МБ, сжимаем его
         if file_size_mb > 50:
             crf = 28
+            preset = 'fast'
         else:
+            # Размер не критичен — кодируем как можно быстрее
             crf = 23
+            preset = 'ultrafast'
         
+        threads = str(threads)
         cmd = [
             'ffmpeg',
+            '-loglevel', 'error',
+            '-nostats',
             '-i', input_path,
+            '-threads', threads,
+            '-filter_threads', threads,
+            '-filter_complex_threads', threads,
             '-c:v', 'libx264',
-            '-preset', 'fast',
+            '-preset', preset,
             '-crf', str(crf),
             '-c:a', 'aac',
             '-b:a', '128k',
@@ -309,24 +797,19 @@ def optimize_for_telegram(input_path: str, output_path: str) -> bool:
             output_path
         ]
         
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=300
-        )
+        rc, _, stderr = await run_ffmpeg(cmd)
         
-        if result.returncode != 0:
-            logger.error(f"FFmpeg error: {result.stderr}")
-            shutil.copy2(input_path, output_path)
+        if rc != 0:
+            # Хватит хвоста — там сама ошибка
+            logger.error(f"FFmpeg error: {stderr[-4096:].decode('utf-8', 'replace')}")
+            await _alink_or_copy(input_path, output_path)
             return False
             
         return True
         
     except Exception as e:
         logger.error(f"Error optimizing video: {e}")
-        import shutil
-        shutil.copy2(input_path, output_path)
+        await _alink_or_copy(input_path, output_path)
         return False
 
 
@@ -352,6 +835,281 @@ def get_video_info_for_audio(video_info: dict) -> dict:
     return metadata
 
 
+async def tag_audio(path: str, metadata: dict):
+    """Записывает теги в mp3 отдельным проходом ffmpeg (-c copy)"""
+    meta_path = path + "_meta.mp3"
+    if await add_metadata_to_audio(path, meta_path, metadata):
+        await aos.replace(meta_path, path)
+    else:
+        await _aremove_quiet(meta_path)
+
+
+# Блок чтения при загрузке в телеграм (у FSInputFile по умолчанию 64 КБ)
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+
+def streamed_input(path: str) -> FSInputFile:
+    """Файл для отправки: читается с диска блоками по UPLOAD_CHUNK_SIZE, целиком в память не грузится"""
+    return FSInputFile(path, chunk_size=UPLOAD_CHUNK_SIZE)
+
+
+def format_caption(header: str, size_bytes: int) -> str:
+    """Собирает HTML-подпись об успешной отправке"""
+    return "\n".join((
+        f"✅ <b>{header}</b>",
+        f"📦 Размер: {size_bytes / 1048576:.1f} МБ",
+    ))
+
+
+# file_id уже загруженных в телеграм файлов: повторная отправка без загрузки
+FILE_ID_CACHE = LRUCache(maxsize=50_000)
+# Лежит вне CACHE_DIR, чтобы очистка кэша его не трогала
+FILE_IDS_PATH = os.path.join(DOWNLOAD_DIR, "file_ids.json")
+# Как часто сбрасывать изменения на диск (секунды)
+FILE_IDS_SAVE_INTERVAL = 60
+
+_file_ids_dirty = False
+
+
+def load_file_ids():
+    """Загружает сохраненные file_id при старте"""
+    try:
+        with open(FILE_IDS_PATH, encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        logger.error(f"Error loading file ids: {e}")
+        return
+    if not isinstance(data, dict):
+        logger.warning("Ignoring file ids: unexpected format")
+        return
+    skipped = 0
+    for key, entry in data.items():
+        # Это только кэш: битые записи (старый формат, ручная правка) пропускаем
+        if not isinstance(entry, list) or len(entry) != 3:
+            skipped += 1
+            continue
+        kind, file_id, size = entry
+        FILE_ID_CACHE[key] = (kind, file_id, size)
+    if skipped:
+        logger.warning(f"Skipped {skipped} malformed file id entries")
+    logger.info(f"Loaded {len(FILE_ID_CACHE)} file ids")
+
+
+def _save_file_ids(snapshot: dict):
+    tmp = FILE_IDS_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(snapshot, f)
+    os.replace(tmp, FILE_IDS_PATH)
+
+
+def mark_file_ids_dirty():
+    """Отмечает, что file_id изменились; на диск их запишет flush_file_ids"""
+    global _file_ids_dirty
+    _file_ids_dirty = True
+
+
+async def flush_file_ids():
+    """Записывает file_id на диск, если с прошлой записи что-то изменилось"""
+    global _file_ids_dirty
+    if not _file_ids_dirty:
+        return
+    _file_ids_dirty = False
+    try:
+        await asyncio.to_thread(_save_file_ids, dict(FILE_ID_CACHE))
+    except Exception as e:
+        # Не пробрасываем: иначе периодическое сохранение остановится насовсем.
+        # Изменения не теряем — запишем в следующий раз
+        _file_ids_dirty = True
+        logger.error(f"Error saving file ids: {e}")
+
+
+async def scheduled_file_ids_save():
+    """Периодически сохраняет file_id: весь файл переписывается не чаще раза в интервал"""
+    while True:
+        await asyncio.sleep(FILE_IDS_SAVE_INTERVAL)
+        await flush_file_ids()
+
+
+def _file_key(path: str) -> str:
+    """Ключ кэша из пути файла в кэше (<key>.<ext>)"""
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+async def _answer_media(message: Message, media, kind: str, label: str, size: int) -> Message:
+    """Отправляет файл или file_id нужным методом с подписью о размере"""
+    if kind == "video":
+        caption = format_caption(f"Готово!{label}", size)
+        return await message.answer_video(
+            media,
+            caption=caption,
+            parse_mode="HTML",
+            supports_streaming=True,
+        )
+    if kind == "audio":
+        caption = format_caption(f"Готово!{label}", size)
+        return await message.answer_audio(media, caption=caption, parse_mode="HTML")
+    caption = format_caption(f"Отправлено как документ{label}", size)
+    return await message.answer_document(media, caption=caption, parse_mode="HTML")
+
+
+async def send_media(
+    message: Message,
+    status: EditThrottler,
+    path: str,
+    kind: Literal["video", "audio", "document"],
+    label: str = "",
+    size: Optional[int] = None,
+) -> bool:
+    """
+    Отправляет файл с подписью о размере одним запросом.
+    Если видео не отправилось — повторяет попытку документом.
+    """
+    # Статус «Отправляю…» должен появиться до начала загрузки файла
+    await status.flush()
+    try:
+        if size is None:
+            size = (await aos.stat(path)).st_size
+
+        sent = await _answer_media(message, streamed_input(path), kind, label, size)
+        media = getattr(sent, kind, None)
+        if media is not None:
+            FILE_ID_CACHE[_file_key(path)] = (kind, media.file_id, size)
+            mark_file_ids_dirty()
+        return True
+    except Exception as e:
+        logger.error(f"Error sending {kind}: {e}")
+        if kind == "video":
+            return await send_media(message, status, path, "document", label, size)
+        await status.edit_text(
+            "❌ Ошибка при отправке аудио" if kind == "audio" else "❌ Ошибка при отправке файла"
+        )
+        return False
+
+
+async def send_by_file_id(message: Message, status: EditThrottler, key: str, label: str) -> bool:
+    """Отправляет ранее загруженный файл по file_id; False — file_id нет или отправить по нему не вышло"""
+    cached = FILE_ID_CACHE.get(key)
+    if cached is None:
+        return False
+    kind, file_id, size = cached
+    await status.flush()
+    try:
+        await _answer_media(message, file_id, kind, label, size)
+        return True
+    except TelegramBadRequest as e:
+        # Телеграм не принял file_id — запись больше не нужна
+        logger.warning(f"Stale file id for {key}: {e}")
+        FILE_ID_CACHE.pop(key, None)
+        mark_file_ids_dirty()
+        return False
+    except Exception as e:
+        # Сетевая ошибка не значит, что file_id протух: оставляем его
+        logger.error(f"Error sending by file id {key}: {e}")
+        return False
+
+
+async def send_from_cache(
+    message: Message,
+    status: EditThrottler,
+    final_path: str,
+    what: str,
+    kind: Literal["video", "audio", "document"],
+    label: str = "",
+) -> bool:
+    """
+    Если файл уже отправлялся или есть в кэше — отправляет его и возвращает True.
+    what — что отправляем, для статуса («видео», «аудио»…).
+    """
+    key = _file_key(final_path)
+    if key in FILE_ID_CACHE:
+        await status.edit_text(f"📤 <b>Отправляю {what} из кэша…</b>", parse_mode="HTML")
+        if await send_by_file_id(message, status, key, label):
+            return True
+
+    try:
+        st = await _astat_or_none(final_path)
+        if st is None:
+            return False
+        await _atouch_cache_file(final_path, st.st_size)
+    except OSError as e:
+        # Файл могла удалить очистка кэша — просто качаем заново
+        logger.warning(f"Cache file unavailable {final_path}: {e}")
+        return False
+    await status.edit_text(f"📤 <b>Отправляю {what} из кэша…</b>", parse_mode="HTML")
+    await send_media(message, status, final_path, kind, label, size=st.st_size)
+    return True
+
+
+def release_download(user_id: int, cancel_event: CancelEvent):
+    """
+    Убирает запись из ACTIVE_DOWNLOADS, только если она принадлежит этой загрузке:
+    новая загрузка того же пользователя не должна потерять кнопку отмены.
+    """
+    data = ACTIVE_DOWNLOADS.get(user_id)
+    if data is not None and data["cancel"] is cancel_event:
+        ACTIVE_DOWNLOADS.pop(user_id, None)
+
+
+async def claim_inflight(key: str, status: EditThrottler) -> Optional[asyncio.Future]:
+    """
+    Занимает ключ загрузки за этим обработчиком.
+    Если этот же файл уже качается для другого пользователя — сначала ждет окончания.
+    Возвращает future, которую надо отдать в finish_inflight,
+    или None, если чужая загрузка закончилась неудачей.
+    """
+    while (future := INFLIGHT.get(key)) is not None:
+        await status.edit_text("⏳ <b>Этот файл уже загружается, жду…</b>", parse_mode="HTML")
+        # shield: отмена ожидающего не должна отменять общую future
+        if not await asyncio.shield(future):
+            return None
+    # Между проверкой и записью нет await — два обработчика не займут ключ одновременно
+    future = asyncio.get_running_loop().create_future()
+    INFLIGHT[key] = future
+    return future
+
+
+def finish_inflight(key: str, future: asyncio.Future, final_path: str):
+    """Освобождает ключ и будит всех, кто ждет этот файл"""
+    # Убираем запись, только если она наша (как в release_download)
+    if INFLIGHT.get(key) is future:
+        del INFLIGHT[key]
+    if not future.done():
+        future.set_result(os.path.exists(final_path))
+
+
+async def claim_or_send_cached(
+    message: Message,
+    status: EditThrottler,
+    key: str,
+    final_path: str,
+    what: str,
+    kind: Literal["video", "audio", "document"],
+    label: str,
+    error_text: str,
+) -> Optional[asyncio.Future]:
+    """
+    Отправляет файл из кэша или занимает ключ для загрузки.
+    Ключ держим только на время проверки, а не на время отправки:
+    иначе пользователи одного кэшированного файла получали бы его по очереди.
+    Возвращает future для finish_inflight, если файл надо качать;
+    None — запрос уже обработан (файл отправлен или чужая загрузка не удалась).
+    """
+    while True:
+        if await send_from_cache(message, status, final_path, what, kind, label):
+            return None
+        # Если этот файл уже качается для другого пользователя — ждем его
+        inflight = await claim_inflight(key, status)
+        if inflight is None:
+            await status.edit_text(error_text)
+            return None
+        # Пока ждали, файл могла скачать чужая загрузка — тогда отдаем его из кэша
+        if await _astat_or_none(final_path) is None:
+            return inflight
+        finish_inflight(key, inflight, final_path)
+
+
 # -------------------- handlers --------------------
 
 @dp.message(F.text == "/start")
@@ -394,11 +1152,9 @@ async def help_command(message: Message):
 async def cache_stats(message: Message):
     """Показывает статистику кэша"""
     try:
-        total_size_mb = get_cache_size_mb()
-        file_count = 0
-        
-        for root, dirs, files in os.walk(CACHE_DIR):
-            file_count += len(files)
+        sizes = [size for _, _, size in _cache_index_snapshot()]
+        file_count = len(sizes)
+        total_size_mb = sum(sizes) / (1024 * 1024)
         
         await message.answer(
             f"📊 <b>Статистика кэша:</b>\n\n"
@@ -419,12 +1175,13 @@ async def handle_link(message: Message):
     
     USER_URLS[user_id] = url
     
-    # Определяем платформу
-    platform_info = await asyncio.to_thread(get_platform_info, url)
+    # Определяем платформу (только regex — поток не нужен)
+    platform_info = get_platform_info(url)
     
     # Для TikTok показываем специальное меню
     if platform_info == "tiktok":
         USER_DATA[user_id] = {"platform": platform_info}
+        prewarm_info(url)
         await message.answer(
             f"🎵 <b>Ссылка с TikTok</b>\n\n"
             "Выберите что скачать:",
@@ -448,6 +1205,9 @@ async def handle_link(message: Message):
     except:
         pass
     
+    # Пока пользователь выбирает формат, получаем метаданные для аудио
+    prewarm_info(url)
+    
     # Для Instagram предлагаем оригинальное качество
     if platform_info == "instagram":
         USER_DATA[user_id] = {"platform": platform_info}
@@ -497,112 +1257,90 @@ async def handle_tiktok_music(callback: CallbackQuery):
         return
     
     await callback.message.edit_reply_markup(reply_markup=None)
-    status = await callback.message.answer("🎵 <b>Извлекаю звук из TikTok…</b>", parse_mode="HTML")
+    status = EditThrottler(await callback.message.answer("🎵 <b>Извлекаю звук из TikTok…</b>", parse_mode="HTML"))
     
     key = cache_key(url, "tiktok_music", audio=True)
     final_path = cache_path(CACHE_DIR, key, "mp3")
-    tmp_path = os.path.join(TMP_DIR, f"{key}.mp3")
+    tmp_path = work_path(key, ".mp3")
     
-    # Создаем директории если не существуют
-    os.makedirs(TMP_DIR, exist_ok=True)
-    os.makedirs(os.path.dirname(final_path), exist_ok=True)
-    
-    # Проверяем кэш
-    if os.path.exists(final_path):
-        await status.edit_text("📤 <b>Отправляю звук из кэша…</b>", parse_mode="HTML")
-        try:
-            await callback.message.answer_audio(FSInputFile(final_path))
-            size_mb = os.path.getsize(final_path) / 1024 / 1024
-            await callback.message.answer(
-                f"✅ <b>Готово! (Звук из TikTok)</b>\n📦 Размер: {size_mb:.1f} МБ",
-                parse_mode="HTML"
-            )
-        except Exception as e:
-            logger.error(f"Error sending cached audio: {e}")
-            await status.edit_text("❌ Ошибка при отправке звука")
+    inflight = await claim_or_send_cached(
+        callback.message, status, key, final_path, "звук", "audio", " (Звук из TikTok)",
+        error_text="❌ Не удалось извлечь звук",
+    )
+    if inflight is None:
+        await status.flush()
         return
     
-    cancel_event = threading.Event()
+    cancel_event = CancelEvent()
     ACTIVE_DOWNLOADS[user_id] = {"cancel": cancel_event}
     loop = asyncio.get_running_loop()
     progress_cb = make_progress_cb(loop, status)
     
     try:
+        # Теги пишутся в том же проходе ffmpeg, что и mp3, поэтому метаданные нужны заранее
+        metadata = None
+        try:
+            info = await get_info_cached(url)
+            if info:
+                metadata = get_video_info_for_audio(info)
+        except Exception as e:
+            logger.error(f"Error getting metadata for audio: {e}")
+        
         # Загружаем звук из TikTok
-        await asyncio.to_thread(
+        tagged = await run_download(
+            cancel_event,
             download_tiktok_music,
             url,
             tmp_path,
             COOKIES_FILE,
-            cancel_event,
+            cancel_event.thread_event,
             progress_cb,
+            threads=DL_FFMPEG_THREADS,
+            metadata=metadata,
         )
         
         # Проверяем, был ли отменен процесс
         if cancel_event.is_set():
             await status.edit_text("⛔ Загрузка отменена")
-            if os.path.exists(tmp_path):
-                os.remove(tmp_path)
+            await _aremove_quiet(tmp_path)
             return
         
-        # Проверяем, создан ли файл
-        if not os.path.exists(tmp_path):
+        # Проверяем, создан ли файл и не пустой ли он
+        st = await _astat_or_none(tmp_path)
+        if st is None:
             raise Exception("Аудио файл не был создан")
-            
-        # Проверяем размер файла
-        file_size = os.path.getsize(tmp_path)
-        if file_size == 0:
-            os.remove(tmp_path)
+        if st.st_size == 0:
+            await aos.remove(tmp_path)
             raise Exception("Создан пустой аудио файл")
         
-        # Добавляем метаданные к аудио
-        try:
-            info = await asyncio.to_thread(extract_info, url, COOKIES_FILE)
-            if info:
-                metadata = get_video_info_for_audio(info)
-                await asyncio.to_thread(add_metadata_to_audio, tmp_path, tmp_path + "_meta.mp3", metadata)
-                if os.path.exists(tmp_path + "_meta.mp3"):
-                    os.remove(tmp_path)
-                    os.rename(tmp_path + "_meta.mp3", tmp_path)
-        except Exception as e:
-            logger.error(f"Error adding metadata to audio: {e}")
+        # Исходник уже был mp3 — yt-dlp не конвертировал, теги дописываем отдельно
+        if metadata and not tagged:
+            await tag_audio(tmp_path, metadata)
         
-        # Перемещаем файл в кэш
-        if os.path.exists(final_path):
-            os.remove(final_path)
-        os.rename(tmp_path, final_path)
+        # Перемещаем файл в кэш (os.replace атомарно перезаписывает старый)
+        await aos.replace(tmp_path, final_path)
+        size = await _aregister_cache_file(final_path)
         
     except DownloadCancelled:
         await status.edit_text("⛔ Загрузка отменена")
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
+        after_worker(cancel_event, _remove_quiet, tmp_path)
         return
     except Exception as e:
         logger.error(f"Error downloading TikTok music: {str(e)}")
         await status.edit_text(f"❌ Ошибка: {str(e)[:100]}")
-        if os.path.exists(tmp_path):
-            try:
-                os.remove(tmp_path)
-            except:
-                pass
+        await _aremove_quiet(tmp_path)
         return
     finally:
-        ACTIVE_DOWNLOADS.pop(user_id, None)
+        release_download(user_id, cancel_event)
+        # Ключ освобождаем, только когда поток загрузки больше не пишет в tmp_path
+        after_worker(cancel_event, finish_inflight, key, inflight, final_path)
+        # Итог (ошибка, отмена) не должен застрять в очереди троттлера
+        await status.flush()
     
     await status.edit_text("📤 <b>Отправляю звук…</b>", parse_mode="HTML")
+    await send_media(callback.message, status, final_path, "audio", " (Звук из TikTok)", size=size)
     
-    try:
-        await callback.message.answer_audio(FSInputFile(final_path))
-        size_mb = os.path.getsize(final_path) / 1024 / 1024
-        await callback.message.answer(
-            f"✅ <b>Готово! (Звук из TikTok)</b>\n📦 Размер: {size_mb:.1f} МБ",
-            parse_mode="HTML"
-        )
-    except Exception as e:
-        logger.error(f"Error sending audio: {e}")
-        await status.edit_text("❌ Ошибка при отправке звука")
-    
-    cleanup_tmp(TMP_DIR)
+    schedule_tmp_cleanup()
 
 
 # ---------------- ORIGINAL QUALITY HANDLERS ----------------
@@ -622,54 +1360,51 @@ async def handle_original_quality(callback: CallbackQuery):
         return
     
     await callback.message.edit_reply_markup(reply_markup=None)
-    status = await callback.message.answer("🎬 <b>Загрузка в оригинальном качестве…</b>", parse_mode="HTML")
+    status = EditThrottler(await callback.message.answer("🎬 <b>Загрузка в оригинальном качестве…</b>", parse_mode="HTML"))
     
     key = cache_key(url, "original", audio=False)
     final_path = cache_path(CACHE_DIR, key, "mp4")
-    tmp_path = os.path.join(TMP_DIR, f"{key}.mp4")
+    tmp_path = work_path(key, ".mp4")
     
-    # Проверяем кэш
-    if os.path.exists(final_path):
-        await status.edit_text("📤 <b>Отправляю файл из кэша…</b>", parse_mode="HTML")
-        try:
-            await callback.message.answer_video(FSInputFile(final_path))
-            size_mb = os.path.getsize(final_path) / 1024 / 1024
-            await callback.message.answer(
-                f"✅ <b>Готово! (Оригинальное качество)</b>\n📦 Размер: {size_mb:.1f} МБ",
-                parse_mode="HTML"
-            )
-        except Exception as e:
-            logger.error(f"Error sending cached file: {e}")
-            await status.edit_text("❌ Ошибка при отправке файла")
+    inflight = await claim_or_send_cached(
+        callback.message, status, key, final_path, "файл", "video", " (Оригинальное качество)",
+        error_text=(
+            "❌ Не удалось скачать в оригинальном качестве\n"
+            "💡 Попробуй обычное качество"
+        ),
+    )
+    if inflight is None:
+        await status.flush()
         return
     
-    cancel_event = threading.Event()
+    cancel_event = CancelEvent()
     ACTIVE_DOWNLOADS[user_id] = {"cancel": cancel_event}
     loop = asyncio.get_running_loop()
     progress_cb = make_progress_cb(loop, status)
     
     try:
-        await asyncio.to_thread(
+        await run_download(
+            cancel_event,
             download_original_quality,
             url,
             tmp_path,
             COOKIES_FILE,
-            cancel_event,
+            cancel_event.thread_event,
             progress_cb,
+            threads=DL_FFMPEG_THREADS,
         )
         
         if cancel_event.is_set():
-            if os.path.exists(tmp_path):
-                os.remove(tmp_path)
+            await _aremove_quiet(tmp_path)
             await status.edit_text("⛔ Загрузка отменена")
             return
             
-        os.rename(tmp_path, final_path)
+        await aos.replace(tmp_path, final_path)
+        size = await _aregister_cache_file(final_path)
         
     except DownloadCancelled:
         await status.edit_text("⛔ Загрузка отменена")
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
+        after_worker(cancel_event, _remove_quiet, tmp_path)
         return
     except Exception as e:
         logger.error(f"Error downloading original quality: {e}")
@@ -677,40 +1412,21 @@ async def handle_original_quality(callback: CallbackQuery):
             "❌ Не удалось скачать в оригинальном качестве\n"
             "💡 Попробуй обычное качество"
         )
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
+        await _aremove_quiet(tmp_path)
         return
     finally:
-        ACTIVE_DOWNLOADS.pop(user_id, None)
+        release_download(user_id, cancel_event)
+        # Ключ освобождаем, только когда поток загрузки больше не пишет в tmp_path
+        after_worker(cancel_event, finish_inflight, key, inflight, final_path)
+        # Итог (ошибка, отмена) не должен застрять в очереди троттлера
+        await status.flush()
     
     await status.edit_text("📤 <b>Отправляю видео…</b>", parse_mode="HTML")
     
-    try:
-        await callback.message.answer_video(
-            FSInputFile(final_path),
-            supports_streaming=True
-        )
-        size_mb = os.path.getsize(final_path) / 1024 / 1024
-        await callback.message.answer(
-            f"✅ <b>Готово! (Оригинальное качество)</b>\n📦 Размер: {size_mb:.1f} МБ",
-            parse_mode="HTML"
-        )
-    except Exception as e:
-        logger.error(f"Error sending video: {e}")
-        try:
-            await callback.message.answer_document(FSInputFile(final_path))
-            size_mb = os.path.getsize(final_path) / 1024 / 1024
-            await callback.message.answer(
-                f"✅ <b>Отправлено как документ (Оригинальное качество)</b>\n📦 Размер: {size_mb:.1f} МБ",
-                parse_mode="HTML"
-            )
-        except Exception as e2:
-            logger.error(f"Error sending as document: {e2}")
-            await status.edit_text("❌ Ошибка при отправке файла")
-            if os.path.exists(final_path):
-                os.remove(final_path)
+    if not await send_media(callback.message, status, final_path, "video", " (Оригинальное качество)", size=size):
+        await _aremove_cache_file(final_path)
     
-    cleanup_tmp(TMP_DIR)
+    schedule_tmp_cleanup()
 
 
 # ---------------- STANDARD VIDEO HANDLER ----------------
@@ -731,70 +1447,67 @@ async def handle_video(callback: CallbackQuery):
         return
 
     await callback.message.edit_reply_markup(reply_markup=None)
-    status = await callback.message.answer("🔍 <b>Анализирую ссылку…</b>", parse_mode="HTML")
+    status = EditThrottler(await callback.message.answer("🔍 <b>Анализирую ссылку…</b>", parse_mode="HTML"))
 
     key = cache_key(url, quality, audio=False)
     final_path = cache_path(CACHE_DIR, key, "mp4")
-    tmp_path = os.path.join(TMP_DIR, f"{key}.mp4")
-    optimized_path = os.path.join(TMP_DIR, f"{key}_optimized.mp4")
+    tmp_path = work_path(key, ".mp4")
+    optimized_path = work_path(key, "_optimized.mp4")
 
-    # Проверяем кэш
-    if os.path.exists(final_path):
-        await status.edit_text("📤 <b>Отправляю файл из кэша…</b>", parse_mode="HTML")
-        try:
-            await callback.message.answer_video(FSInputFile(final_path))
-            size_mb = os.path.getsize(final_path) / 1024 / 1024
-            await callback.message.answer(
-                f"✅ <b>Готово!</b>\n📦 Размер: {size_mb:.1f} МБ",
-                parse_mode="HTML"
-            )
-        except Exception as e:
-            logger.error(f"Error sending cached file: {e}")
-            await status.edit_text("❌ Ошибка при отправке файла")
+    inflight = await claim_or_send_cached(
+        callback.message, status, key, final_path, "файл", "video", "",
+        error_text=(
+            "❌ Не удалось скачать видео\n"
+            "💡 Попробуй другое качество"
+        ),
+    )
+    if inflight is None:
+        await status.flush()
         return
 
-    cancel_event = threading.Event()
+    cancel_event = CancelEvent()
     ACTIVE_DOWNLOADS[user_id] = {"cancel": cancel_event}
     loop = asyncio.get_running_loop()
     progress_cb = make_progress_cb(loop, status)
 
     try:
-        await asyncio.to_thread(
+        await run_download(
+            cancel_event,
             download_video,
             url,
             quality,
             tmp_path,
             COOKIES_FILE,
-            cancel_event,
+            cancel_event.thread_event,
             progress_cb,
+            threads=DL_FFMPEG_THREADS,
         )
         
         # Проверяем, был ли отменен процесс
         if cancel_event.is_set():
-            if os.path.exists(tmp_path):
-                os.remove(tmp_path)
+            await _aremove_quiet(tmp_path)
             await status.edit_text("⛔ Загрузка отменена")
             return
         
         # Оптимизируем видео для телеграма (кроме оригинального качества)
         if quality != "original":
             await status.edit_text("⚙️ <b>Оптимизирую видео для телеграма…</b>", parse_mode="HTML")
-            await asyncio.to_thread(optimize_for_telegram, tmp_path, optimized_path)
+            async with ffmpeg_slot() as threads:
+                await optimize_for_telegram(tmp_path, optimized_path, threads)
             
-            # Удаляем исходный файл и используем оптимизированный
-            if os.path.exists(tmp_path):
-                os.remove(tmp_path)
-                
-            os.rename(optimized_path, final_path)
+            # Сразу отдаем оптимизированный файл, исходник удаляем в фоне,
+            # чтобы unlink большого файла не задерживал отправку
+            await aos.replace(optimized_path, final_path)
+            run_in_background(_remove_quiet, tmp_path)
         else:
             # Для оригинального качества не оптимизируем
-            os.rename(tmp_path, final_path)
+            await aos.replace(tmp_path, final_path)
+        size = await _aregister_cache_file(final_path)
         
     except DownloadCancelled:
         await status.edit_text("⛔ Загрузка отменена")
-        for path in [tmp_path, optimized_path]:
-            if os.path.exists(path):
-                os.remove(path)
+        for path in (tmp_path, optimized_path):
+            after_worker(cancel_event, _remove_quiet, path)
         return
     except Exception as e:
         logger.error(f"Error downloading video: {e}")
@@ -802,41 +1515,22 @@ async def handle_video(callback: CallbackQuery):
             "❌ Не удалось скачать видео\n"
             "💡 Попробуй другое качество"
         )
-        for path in [tmp_path, optimized_path]:
-            if os.path.exists(path):
-                os.remove(path)
+        for path in (tmp_path, optimized_path):
+            await _aremove_quiet(path)
         return
     finally:
-        ACTIVE_DOWNLOADS.pop(user_id, None)
+        release_download(user_id, cancel_event)
+        # Ключ освобождаем, только когда поток загрузки больше не пишет в tmp_path
+        after_worker(cancel_event, finish_inflight, key, inflight, final_path)
+        # Итог (ошибка, отмена) не должен застрять в очереди троттлера
+        await status.flush()
 
     await status.edit_text("📤 <b>Отправляю видео…</b>", parse_mode="HTML")
 
-    try:
-        await callback.message.answer_video(
-            FSInputFile(final_path),
-            supports_streaming=True
-        )
-        size_mb = os.path.getsize(final_path) / 1024 / 1024
-        await callback.message.answer(
-            f"✅ <b>Готово!</b>\n📦 Размер: {size_mb:.1f} МБ",
-            parse_mode="HTML"
-        )
-    except Exception as e:
-        logger.error(f"Error sending video: {e}")
-        try:
-            await callback.message.answer_document(FSInputFile(final_path))
-            size_mb = os.path.getsize(final_path) / 1024 / 1024
-            await callback.message.answer(
-                f"✅ <b>Отправлено как документ</b>\n📦 Размер: {size_mb:.1f} МБ",
-                parse_mode="HTML"
-            )
-        except Exception as e2:
-            logger.error(f"Error sending as document: {e2}")
-            await status.edit_text("❌ Ошибка при отправке файла")
-            if os.path.exists(final_path):
-                os.remove(final_path)
+    if not await send_media(callback.message, status, final_path, "video", size=size):
+        await _aremove_cache_file(final_path)
 
-    cleanup_tmp(TMP_DIR)
+    schedule_tmp_cleanup()
 
 
 # ---------------- STANDARD AUDIO HANDLER ----------------
@@ -856,114 +1550,89 @@ async def handle_audio(callback: CallbackQuery):
         return
 
     await callback.message.edit_reply_markup(reply_markup=None)
-    status = await callback.message.answer("🎧 <b>Подготовка аудио…</b>", parse_mode="HTML")
+    status = EditThrottler(await callback.message.answer("🎧 <b>Подготовка аудио…</b>", parse_mode="HTML"))
 
     # Получаем информацию о видео для метаданных
     video_info = None
     try:
-        video_info = await asyncio.to_thread(extract_info, url, COOKIES_FILE)
+        video_info = await get_info_cached(url)
     except:
         pass
 
     key = cache_key(url, "audio", audio=True)
     final_path = cache_path(CACHE_DIR, key, "mp3")
-    tmp_path = os.path.join(TMP_DIR, f"{key}.mp3")
-
-    # Создаем директории если не существуют
-    os.makedirs(TMP_DIR, exist_ok=True)
-    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+    tmp_path = work_path(key, ".mp3")
 
-    # Проверяем кэш
-    if os.path.exists(final_path):
-        await status.edit_text("📤 <b>Отправляю аудио из кэша…</b>", parse_mode="HTML")
-        try:
-            await callback.message.answer_audio(FSInputFile(final_path))
-            size_mb = os.path.getsize(final_path) / 1024 / 1024
-            await callback.message.answer(
-                f"✅ <b>Готово!</b>\n📦 Размер: {size_mb:.1f} МБ",
-                parse_mode="HTML"
-            )
-        except Exception as e:
-            logger.error(f"Error sending cached audio: {e}")
-            await status.edit_text("❌ Ошибка при отправке аудио")
+    inflight = await claim_or_send_cached(
+        callback.message, status, key, final_path, "аудио", "audio", "",
+        error_text="❌ Не удалось скачать аудио",
+    )
+    if inflight is None:
+        await status.flush()
         return
 
-    cancel_event = threading.Event()
+    cancel_event = CancelEvent()
     ACTIVE_DOWNLOADS[user_id] = {"cancel": cancel_event}
     loop = asyncio.get_running_loop()
     progress_cb = make_progress_cb(loop, status)
 
     try:
-        await asyncio.to_thread(
+        metadata = get_video_info_for_audio(video_info) if video_info else None
+        tagged = await run_download(
+            cancel_event,
             download_audio,
             url,
             tmp_path,
             COOKIES_FILE,
-            cancel_event,
+            cancel_event.thread_event,
             progress_cb,
+            metadata,
+            threads=DL_FFMPEG_THREADS,
+            info=video_info,
         )
         
         # Проверяем, был ли отменен процесс
         if cancel_event.is_set():
             await status.edit_text("⛔ Загрузка отменена")
-            if os.path.exists(tmp_path):
-                os.remove(tmp_path)
+            await _aremove_quiet(tmp_path)
             return
         
-        # Проверяем, создан ли файл
-        if not os.path.exists(tmp_path):
+        # Проверяем, создан ли файл и не пустой ли он
+        st = await _astat_or_none(tmp_path)
+        if st is None:
             raise Exception("Аудио файл не был создан")
-            
-        # Проверяем размер файла
-        file_size = os.path.getsize(tmp_path)
-        if file_size == 0:
-            os.remove(tmp_path)
+        if st.st_size == 0:
+            await aos.remove(tmp_path)
             raise Exception("Создан пустой аудио файл")
         
-        # Добавляем метаданные к аудио
-        if video_info:
-            metadata = get_video_info_for_audio(video_info)
-            await asyncio.to_thread(add_metadata_to_audio, tmp_path, tmp_path + "_meta.mp3", metadata)
-            if os.path.exists(tmp_path + "_meta.mp3"):
-                os.remove(tmp_path)
-                os.rename(tmp_path + "_meta.mp3", tmp_path)
+        # Исходник уже был mp3 — yt-dlp не конвертировал, теги дописываем отдельно
+        if metadata and not tagged:
+            await tag_audio(tmp_path, metadata)
         
-        # Перемещаем файл в кэш
-        if os.path.exists(final_path):
-            os.remove(final_path)
-        os.rename(tmp_path, final_path)
+        # Перемещаем файл в кэш (os.replace атомарно перезаписывает старый)
+        await aos.replace(tmp_path, final_path)
+        size = await _aregister_cache_file(final_path)
         
     except DownloadCancelled:
         await status.edit_text("⛔ Загрузка отменена")
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
+        after_worker(cancel_event, _remove_quiet, tmp_path)
         return
     except Exception as e:
         logger.error(f"Error downloading audio: {str(e)}")
         await status.edit_text(f"❌ Ошибка: {str(e)[:100]}")
-        if os.path.exists(tmp_path):
-            try:
-                os.remove(tmp_path)
-            except:
-                pass
+        await _aremove_quiet(tmp_path)
         return
     finally:
-        ACTIVE_DOWNLOADS.pop(user_id, None)
+        release_download(user_id, cancel_event)
+        # Ключ освобождаем, только когда поток загрузки больше не пишет в tmp_path
+        after_worker(cancel_event, finish_inflight, key, inflight, final_path)
+        # Итог (ошибка, отмена) не должен застрять в очереди троттлера
+        await status.flush()
 
     await status.edit_text("📤 <b>Отправляю аудио…</b>", parse_mode="HTML")
+    await send_media(callback.message, status, final_path, "audio", size=size)
 
-    try:
-        await callback.message.answer_audio(FSInputFile(final_path))
-        size_mb = os.path.getsize(final_path) / 1024 / 1024
-        await callback.message.answer(
-            f"✅ <b>Готово!</b>\n📦 Размер: {size_mb:.1f} МБ",
-            parse_mode="HTML"
-        )
-    except Exception as e:
-        logger.error(f"Error sending audio: {e}")
-        await status.edit_text("❌ Ошибка при отправке аудио")
-
-    cleanup_tmp(TMP_DIR)
+    schedule_tmp_cleanup()
 
 
 # ---------------- PLAYLIST HANDLERS ----------------
@@ -1038,10 +1707,13 @@ async def handle_playlist_confirm(callback: CallbackQuery):
 
 async def download_playlist_confirm(callback, user_id, playlist_info, status):
     """Загружает плейлист после подтверждения"""
+    import uuid
+    
+    status = EditThrottler(status)
+    cancel_event = CancelEvent()
+    # Временная директория для плейлиста; нужна и в ветках отмены и ошибки
+    playlist_dir = os.path.join(TMP_DIR, f"playlist_{uuid.uuid4().hex[:8]}")
     try:
-        import uuid
-        import shutil
-        
         video_count = len(playlist_info['entries'])
         playlist_title = playlist_info.get('title', 'Плейлист')
         
@@ -1053,66 +1725,71 @@ async def download_playlist_confirm(callback, user_id, playlist_info, status):
             parse_mode="HTML"
         )
         
-        cancel_event = threading.Event()
         ACTIVE_DOWNLOADS[user_id] = {"cancel": cancel_event}
         loop = asyncio.get_running_loop()
         progress_cb = make_playlist_progress_cb(loop, status, video_count)
         
-        # Создаем временную директорию для плейлиста
-        playlist_dir = os.path.join(TMP_DIR, f"playlist_{uuid.uuid4().hex[:8]}")
-        os.makedirs(playlist_dir, exist_ok=True)
+        await aos.makedirs(playlist_dir, exist_ok=True)
         
         # Загружаем плейлист
-        downloaded_files = await asyncio.to_thread(
+        downloaded_files = await run_download(
+            cancel_event,
             download_playlist_videos,
             playlist_info,
             playlist_dir,
             COOKIES_FILE,
-            cancel_event,
+            cancel_event.thread_event,
             progress_cb
         )
         
-        if cancel_event.is_set():
-            await status.edit_text("⛔ Загрузка плейлиста отменена")
-            shutil.rmtree(playlist_dir, ignore_errors=True)
-            return
-        
         if not downloaded_files:
             await status.edit_text("❌ Не удалось загрузить видео из плейлиста")
-            shutil.rmtree(playlist_dir, ignore_errors=True)
+            run_in_background(shutil.rmtree, playlist_dir, True)
             return
         
         # Отправляем файлы частями
         await status.edit_text(f"📤 <b>Отправляю {len(downloaded_files)} видео…</b>", parse_mode="HTML")
         
-        # Сортируем файлы по размеру (сначала маленькие)
-        downloaded_files.sort(key=lambda x: os.path.getsize(x))
+        # Сортируем файлы по размеру (сначала маленькие), каждый файл stat'им один раз
+        sized_files = sorted([((await aos.stat(f)).st_size, f) for f in downloaded_files])
+        downloaded_files = [f for _, f in sized_files]
+        total_size = sum(size for size, _ in sized_files)
+        
+        total_files = len(downloaded_files)
+        send_sem = asyncio.Semaphore(3)
         
-        sent_count = 0
-        for i, file_path in enumerate(downloaded_files, 1):
-            if cancel_event.is_set():
-                break
+        async def send_one(i, file_path):
+            async with send_sem:
+                if cancel_event.is_set():
+                    return False
                 
-            try:
                 file_name = os.path.basename(file_path)
                 # Убираем расширение для имени файла
                 display_name = os.path.splitext(file_name)[0]
                 
-                # Отправляем файл с номером в подписи
-                await callback.message.answer_document(
-                    FSInputFile(file_path),
-                    caption=f"🎬 Видео {i}/{len(downloaded_files)}\n📁 {display_name[:50]}"
-                )
-                sent_count += 1
-                
-                # Небольшая пауза между отправками
-                await asyncio.sleep(1)
-                
-            except Exception as e:
-                logger.error(f"Error sending file {file_path}: {e}")
-                continue
+                # Отправляем файл с номером в подписи; на flood control ждем сколько просит телеграм
+                for attempt in range(3):
+                    try:
+                        await callback.message.answer_document(
+                            streamed_input(file_path),
+                            caption=f"🎬 Видео {i}/{total_files}\n📁 {display_name[:50]}"
+                        )
+                        return True
+                    except TelegramRetryAfter as e:
+                        logger.warning(f"Flood control on {file_path}, retry in {e.retry_after}s")
+                        await asyncio.sleep(e.retry_after)
+                return False
+        
+        # Отправляем несколько файлов одновременно
+        results = await asyncio.gather(
+            *(send_one(i, fp) for i, fp in enumerate(downloaded_files, 1)),
+            return_exceptions=True
+        )
+        for file_path, result in zip(downloaded_files, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error sending file {file_path}: {result}")
+        sent_count = sum(1 for result in results if result is True)
         
-        total_size = sum(os.path.getsize(f) for f in downloaded_files)
         total_size_mb = total_size / (1024 * 1024)
         
         await callback.message.answer(
@@ -1125,16 +1802,21 @@ async def download_playlist_confirm(callback, user_id, playlist_info, status):
         )
         
         # Очищаем временные файлы
-        shutil.rmtree(playlist_dir, ignore_errors=True)
+        run_in_background(shutil.rmtree, playlist_dir, True)
         
     except DownloadCancelled:
         await status.edit_text("⛔ Загрузка плейлиста отменена")
+        # cleanup_tmp удаляет только файлы, директорию убираем сами — когда поток перестанет в нее писать
+        after_worker(cancel_event, run_in_background, shutil.rmtree, playlist_dir, True)
     except Exception as e:
         logger.error(f"Error downloading playlist: {e}")
         await status.edit_text(f"❌ Ошибка: {str(e)[:100]}")
+        after_worker(cancel_event, run_in_background, shutil.rmtree, playlist_dir, True)
     finally:
-        ACTIVE_DOWNLOADS.pop(user_id, None)
-        cleanup_tmp(TMP_DIR)
+        release_download(user_id, cancel_event)
+        schedule_tmp_cleanup()
+        # Итог (ошибка, отмена) не должен застрять в очереди троттлера
+        await status.flush()
 
 
 @dp.callback_query(F.data == "playlist_confirm_no")
@@ -1179,21 +1861,29 @@ async def handle_playlist_first(callback: CallbackQuery):
 # -------------------- entrypoint --------------------
 
 async def main():
+    # Метаданные и прочие to_thread идут в META_POOL
+    asyncio.get_running_loop().set_default_executor(META_POOL)
+    
     # Очистка временных файлов при старте
-    cleanup_tmp(TMP_DIR)
+    await asyncio.to_thread(cleanup_work_dirs)
+    await asyncio.to_thread(load_file_ids)
     
     # Запускаем задачу очистки кэша в фоне
     cleanup_task = asyncio.create_task(scheduled_cache_cleanup())
+    file_ids_task = asyncio.create_task(scheduled_file_ids_save())
     
     try:
         await dp.start_polling(bot)
     finally:
-        # Отменяем задачу очистки при выходе
-        cleanup_task.cancel()
-        try:
-            await cleanup_task
-        except asyncio.CancelledError:
-            pass
+        # Отменяем фоновые задачи при выходе
+        for task in (cleanup_task, file_ids_task):
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        # Несохраненные file_id не теряем
+        await flush_file_ids()
 
 if __name__ == "__main__":
     try:
@@ -1,11 +1,22 @@
 import time
-from collections import defaultdict
+import threading
+from collections import OrderedDict
 
-_last_request = defaultdict(float)
+_MAX_USERS = 10000
+
+_last_request = OrderedDict()
+_lock = threading.Lock()
 
 def check_rate_limit(user_id, limit):
-    now = time.time()
-    if now - _last_request[user_id] < limit:
-        return False
-    _last_request[user_id] = now
+    # monotonic не прыгает при подстройке системных часов
+    now = time.monotonic()
+    with _lock:
+        last = _last_request.get(user_id)
+        if last is not None and now - last < limit:
+            return False
+        _last_request[user_id] = now
+        _last_request.move_to_end(user_id)
+        # Самые давние пользователи все равно уже вне лимита
+        if len(_last_request) > _MAX_USERS:
+            _last_request.popitem(last=False)
     return True
\ No newline at end of file